@@ -1,25 +1,70 @@
 #!/usr/bin/env python3
 
-import copy
+import os
+import sys
 import math
 import argparse
+import itertools
+import concurrent.futures
+from operator import attrgetter
 
 
-def interpolate(n, **p):
-    """Return n points from the start to end of each provided range.
+# Output format for the axis and extruder arguments; others pass through.
+_FMT = {'X': ' X%.3f', 'Y': ' Y%.3f', 'Z': ' Z%.3f', 'E': ' E%.5f'}
 
-    >>> list(interpolate(2, x=(1,3), y=(4,8)))
-    [{'x': 2.0, 'y': 6.0}, {'x': 3.0, 'y': 8.0}]
+# Writers for plain moves, keyed by which arguments are set (see __str__).
+_WRITERS = {}
+
+
+def _make_writer(has_f, *types):
+    """Build a (template, getter) pair for one shape of GCode.
+
+    types are the classes of the X, Y, Z and E values. Only shapes
+    whose axis values are all numbers or None can use a template; for
+    anything else None is returned.
+
+    >>> t, get = _make_writer(False, float, float, type(None), float)
+    >>> t
+    '%s X%.3f Y%.3f E%.5f'
 
     """
-    s = {i:(j[1] - j[0]) / n for i, j in p.items()}
-    for i in range(1, n+1):
-        yield {
-            k: p[k][0] + (i * s[k])
-            for k in p
-        }
+    template = ['%s']
+    names = ['command']
+    if has_f:
+        template.append(' F%s')
+        names.append('F')
+    for (k, fmt), t in zip(_FMT.items(), types):
+        if t is float or t is int:
+            template.append(fmt)
+            names.append(k)
+        elif t is not type(None):
+            return None
+    return ''.join(template), attrgetter(*names)
+
+
+def _target_z(y, z, s, my, dy):
+    """Curved Z height at y for a layer at z with depression factor s.
+
+    my and dy are the midpoint and half-width of the Y range.
+
+    >>> _target_z(10.0, 1.0, 0.6, 5.0, 5.0)
+    0.8
+    >>> _target_z(20.0, 1.0, 0.6, 5.0, 5.0)
+    Traceback (most recent call last):
+        ...
+    ValueError: math domain error
+
+    """
+    # transform y into -1 to 1 coordinate space
+    y = (y - my) / dy
+    f = math.sqrt(1 - (y*s)**2)
+
+    return z + f - 1
+
 
 class GCode:
+    __slots__ = ('command', 'comment', 'F', 'X', 'Y', 'Z', 'E', 'extra')
+
     @classmethod
     def parse(cls, line):
         """Parse a line of GCode.
@@ -27,59 +72,153 @@ class GCode:
         >>> GCode.parse('G20')
         <GCode: G20 {} >
         >>> GCode.parse('G92 E0 ; Reset extruder')
-        <GCode: G92 {'E': '0'} ; Reset extruder>
+        <GCode: G92 {'E': 0.0} ; Reset extruder>
+        >>> g = GCode.parse('G1 X1.5 E0.2')
+        >>> g.X, g.Y
+        (1.5, None)
 
         """
-        line = line.rstrip()
-        if ';' in line:
-            command, comment = line.split(';', 1)
+        command, sep, comment = line.rstrip().partition(';')
+        if sep:
             comment = ';' + comment
-        else:
-            command = line
-            comment = ''
-            
-        command = command.strip().split()
-        if len(command) > 1:
-            args = {
-                i[0]: i[1:] for i in command[1:]
-            }
-        else:
-            args = {}
-        if command:
-            command = command[0]
-        else:
-            command = ''
-        
-        return cls(command, args, comment)
+
+        g = cls.__new__(cls)
+        g.comment = comment
+        g.F = g.X = g.Y = g.Z = g.E = g.extra = None
+        words = command.split()
+        if not words:
+            g.command = ''
+            return g
+
+        g.command = words[0]
+        g._fill(words[1:])
+        return g
     
     def __init__(self, cmd, args, comment):
+        """Build a GCode by hand from a command, arguments and a comment.
+
+        parse() fills the slots directly; this is for callers that have
+        the arguments as a {letter: value} dict. The values are sorted
+        into slots by the same rules as parsed text (see _fill()).
+
+        """
         self.command = cmd
-        self.args = args or {}
         self.comment = comment
+        self.F = self.X = self.Y = self.Z = self.E = self.extra = None
+        if args:
+            self._fill([f'{k}{v}' for k, v in args.items()])
+
+    def _fill(self, words):
+        """Set the arguments from words like 'X1.5', in order.
+
+        X, Y, Z and E are stored as floats (or left as text if they
+        are not numbers, as in 'G28 X'), F as given, and any other
+        letters in the extra dict.
+
+        """
+        for w in words:
+            k = w[0]
+            v = w[1:]
+            if k in _FMT:
+                try:
+                    v = float(v)
+                except ValueError:
+                    pass
+                if k == 'X':
+                    self.X = v
+                elif k == 'Y':
+                    self.Y = v
+                elif k == 'Z':
+                    self.Z = v
+                else:
+                    self.E = v
+            elif k == 'F':
+                self.F = v
+            elif self.extra is None:
+                self.extra = {k: v}
+            else:
+                self.extra[k] = v
+
+    def _args(self):
+        """The arguments as a new dict, in output order, for display."""
+        args = {
+            k: getattr(self, k) for k in ('F', 'X', 'Y', 'Z', 'E')
+            if getattr(self, k) is not None
+        }
+        if self.extra:
+            args.update(self.extra)
+        return args
+
+    def clone(self):
+        """Return a copy that can be modified independently.
+
+        >>> g = GCode.parse('G1 X1 Y2')
+        >>> c = g.clone()
+        >>> c.X = 5.0
+        >>> g
+        <GCode: G1 {'X': 1.0, 'Y': 2.0} >
+
+        """
+        g = GCode.__new__(GCode)
+        g.command = self.command
+        g.comment = self.comment
+        g.F = self.F
+        g.X = self.X
+        g.Y = self.Y
+        g.Z = self.Z
+        g.E = self.E
+        g.extra = self.extra.copy() if self.extra else None
+        return g
 
     def __repr__(self):
-        return f'<GCode: {self.command} {self.args} {self.comment}>'
+        return f'<GCode: {self.command} {self._args()} {self.comment}>'
         
     def __str__(self):
         """Convert back to text.
 
-        >>> str(GCode('G1', {'F': '1800', 'X': 109.0}, '; feed'))
+        Arguments are written in a fixed order: F, X, Y, Z, E and then
+        any others in the order they were given.
+
+        >>> str(GCode('G1', {'X': 109.0, 'F': '1800'}, '; feed'))
         'G1 F1800 X109.000 ; feed'
         >>> str(GCode('', {}, ';hello'))
         ';hello'
+        >>> str(GCode.parse('G28 X Y'))
+        'G28 X Y'
+        >>> g = GCode.parse('G1 X1 ; move')
+        >>> g.X = 5
+        >>> str(g), str(GCode('G1', {'Y': 2}, ''))
+        ('G1 X5.000 ; move', 'G1 Y2.000')
 
         """
-        s = ''
-        if self.command:
-            s = self.command
-        for k in self.args:
-            if k == 'E':
-                v = f'{float(self.args[k]):.5f}'
-            elif k in ('X', 'Y', 'Z'):
-                v = f'{float(self.args[k]):.3f}'
+        if self.command and not self.comment and not self.extra:
+            # Plain moves are the bulk of the output, so format them
+            # with one template per shape of arguments.
+            shape = (self.F is not None, self.X.__class__, self.Y.__class__,
+                     self.Z.__class__, self.E.__class__)
+            try:
+                writer = _WRITERS[shape]
+            except KeyError:
+                writer = _WRITERS[shape] = _make_writer(*shape)
+            if writer is not None:
+                template, get = writer
+                return template % get(self)
+
+        parts = [self.command or '']
+        if self.F is not None:
+            parts.append(f' F{self.F}')
+        for k, fmt in _FMT.items():
+            v = getattr(self, k)
+            if v is None:
+                continue
+            if isinstance(v, str):
+                parts.append(f' {k}{v}')
             else:
-                v = self.args[k]
-            s += f' {k}{v}'
+                parts.append(fmt % v)
+        if self.extra:
+            for k, v in self.extra.items():
+                parts.append(f' {k}{v}')
+        s = ''.join(parts)
         if self.comment:
             if s.strip():
                 s = s.strip() + ' '
@@ -94,11 +233,39 @@ class GCodeProcessor:
         self.state = None
 
     def handle_line(self, line):
-        parsed = GCode.parse(line)
-        next_state = self.state(parsed)
-        while next_state:
-            self.state = next_state
-            next_state = self.state(parsed)
+        self.handle_parsed(GCode.parse(line))
+
+    def handle_parsed(self, g):
+        """Process an already-parsed GCode.
+
+        Processors do not modify g, so the same parsed lines can be
+        fed to several of them in turn.
+
+        """
+        self.handle_stream((g,))
+
+    def handle_stream(self, gs):
+        """Run each of an iterable of parsed GCode through the states."""
+        for _ in self.iter_stream(gs):
+            pass
+
+    def iter_stream(self, gs):
+        """Run gs through the states, yielding each one once handled.
+
+        The current state is kept in a local for the duration of the
+        loop and written back when it ends, is closed or fails.
+
+        """
+        state = self.state
+        try:
+            for g in gs:
+                next_state = state(g)
+                while next_state:
+                    state = next_state
+                    next_state = state(g)
+                yield g
+        finally:
+            self.state = state
 
             
 class GCodeScanner(GCodeProcessor):
@@ -106,35 +273,28 @@ class GCodeScanner(GCodeProcessor):
         super().__init__()
         self.state = self.Intro
         self.max_x = 0
-        self.min_x = 9e999
+        self.min_x = math.inf
         self.max_y = 0
-        self.min_y = 9e999
+        self.min_y = math.inf
         self.max_z = 0
         self.min_z = 0
         self.target_depression = td
+        self.my = self.dy = None
 
-    def xmid(self, x):
-        """Transform X to the range (-1,1).
+    def finalize(self):
+        """Compute the Y midpoint and half-width once scanning is done.
+
+        Only Y affects the curve, so there is no X equivalent.
 
         >>> g = GCodeScanner(1)
-        >>> g.max_x = 12.0
-        >>> g.min_x = 4.0
-        >>> g.xmid(4.0)
-        -1.0
-        >>> g.xmid(6.0)
-        -0.5
-        >>> g.xmid(8.0)
-        0.0
-        >>> g.xmid(12.0)
-        1.0
-        
+        >>> g.min_y, g.max_y = 0.0, 10.0
+        >>> g.finalize()
+        >>> g.my, g.dy
+        (5.0, 5.0)
+
         """
-        m = self.min_x + ((self.max_x - self.min_x) / 2.0)
-        return (x - m) / (self.max_x - m)
-        
-    def ymid(self, y):
-        m = self.min_y + ((self.max_y - self.min_y) / 2.0)
-        return (y - m) / (self.max_y - m)
+        self.my = self.min_y + ((self.max_y - self.min_y) / 2.0)
+        self.dy = self.max_y - self.my
 
     def layer_depression(self, z):
         """How much depression for a given layer.
@@ -158,24 +318,29 @@ class GCodeScanner(GCodeProcessor):
             return self.RegionScan
 
     def RegionScan(self, g):
-        if g.command == 'M107':
+        command = g.command
+        if command == 'M107':
             return self.EndStage
-        if g.command == 'G91':
+        if command == 'G91':
             return self.SkipRelativePosition
-        if g.command not in ('G0', 'G1'):
+        if command not in ('G0', 'G1'):
             return
         
-        if 'X' in g.args:
-            x = float(g.args['X'])
-            self.max_x = max(self.max_x, x)
-            self.min_x = min(self.min_x, x)
-        if 'Y' in g.args:
-            y = float(g.args['Y'])
-            self.max_y = max(self.max_y, y)
-            self.min_y = min(self.min_y, y)
-        if 'Z' in g.args:
-            z = float(g.args['Z'])
-            self.max_z = max(self.max_z, z)
+        x = g.X
+        if x is not None:
+            if x > self.max_x:
+                self.max_x = x
+            if x < self.min_x:
+                self.min_x = x
+        y = g.Y
+        if y is not None:
+            if y > self.max_y:
+                self.max_y = y
+            if y < self.min_y:
+                self.min_y = y
+        z = g.Z
+        if z is not None and z > self.max_z:
+            self.max_z = z
 
     def SkipRelativePosition(self, g):
         if g.command == 'G90':
@@ -186,29 +351,112 @@ class GCodeScanner(GCodeProcessor):
 
             
 class GCodeTranslator(GCodeProcessor):
-    def __init__(self, model):
+    def __init__(self, model, segment_length=0.5, max_points=4):
         super().__init__()
+        if model.my is None:
+            raise ValueError('model has not been finalized; call '
+                             'finalize() once scanning is done')
         self.model = model
+        self.segment_length = segment_length
+        self.max_points = max_points
         self.state = self.Intro
         self.output = []
         self.first_z = None
         self.layer_z = 0.0
+        self.layer_s = 0.0
         self.last_x = 0.0
         self.last_y = 0.0
         self.last_z = 0.0
         self.last_e = 0.0
             
-    def target_z(self, x, y, z):
-        # transform x and y into -1 to 1 coordinate space
+    def stream(self, gs):
+        """Translate an iterable of parsed GCode, yielding the output.
+
+        Output is handed on as each line is processed, so self.output
+        never holds more than one line's worth.
+
+        """
+        out = self.output
+        lines = self.iter_stream(gs)
+        try:
+            for _ in lines:
+                if out:
+                    yield from out
+                    out.clear()
+        finally:
+            lines.close()
+
+    def set_layer(self, z):
+        """Start a new layer at height z.
+
+        The depression only depends on the layer, so its curve factor
+        is computed here once rather than for every point.
+
+        """
+        self.layer_z = z
+        if self.first_z is None:
+            self.first_z = z
         # FIXME: the first layer is being affected
         d = self.model.layer_depression(z - self.first_z)
-        x = self.model.xmid(x)
-        y = self.model.ymid(y)
-        
-        s = math.sqrt((2*d) - (d**2))
-        f = math.sqrt(1 - (y*s)**2)
+        self.layer_s = math.sqrt((2*d) - (d**2))
+
+    def target_z(self, y):
+        return _target_z(y, self.layer_z, self.layer_s,
+                         self.model.my, self.model.dy)
+
+    def segment_points(self, x0, x1, y0, y1):
+        """How many points to split a move into.
+
+        Moves shorter than segment_length are emitted as a single
+        point; longer ones get one point per segment_length, up to
+        max_points.
+
+        >>> m = GCodeScanner(1)
+        >>> m.finalize()
+        >>> t = GCodeTranslator(m)
+        >>> t.segment_points(0, 0.3, 0, 0.3)
+        1
+        >>> t.segment_points(0, 1.2, 0, 0)
+        2
+        >>> t.segment_points(0, 30, 0, 40)
+        4
+
+        """
+        seg = math.hypot(x1 - x0, y1 - y0)
+        if seg < self.segment_length:
+            return 1
+        return min(self.max_points, int(seg / self.segment_length))
+
+    def compute_segment(self, x0, x1, y0, y1, e=None, n=4):
+        """Yield n (X, Y, E, Z) points from the start to end of a segment.
+
+        E is None when the move does not extrude.
+
+        >>> m = GCodeScanner(0.1)
+        >>> m.min_x, m.max_x, m.min_y, m.max_y, m.max_z = 0, 10, 0, 10, 2.0
+        >>> m.finalize()
+        >>> t = GCodeTranslator(m)
+        >>> t.first_z = 0.0
+        >>> t.set_layer(1.0)
+        >>> [tuple(round(v, 3) for v in p if v is not None)
+        ...  for p in t.compute_segment(0, 10, 5, 10, n=2)]
+        [(5.0, 7.5, 0.954), (10.0, 10.0, 0.8)]
 
-        return z + f - 1
+        """
+        s = self.layer_s
+        z = self.layer_z
+        my = self.model.my
+        dy = self.model.dy
+        sx = (x1 - x0) / n
+        sy = (y1 - y0) / n
+        if e is not None:
+            e0, e1 = e
+            se = (e1 - e0) / n
+        for i in range(1, n+1):
+            x = x0 + (i * sx)
+            y = y0 + (i * sy)
+            yield (x, y, (e0 + (i * se)) if e is not None else None,
+                   _target_z(y, z, s, my, dy))
             
     def Intro(self, g):
         if g.comment.startswith(';LAYER:'):
@@ -217,7 +465,9 @@ class GCodeTranslator(GCodeProcessor):
             self.output.append(g)
 
     def LayerHeader(self, g):
-        if g.command == 'G0' and 'Z' in g.args:
+        if g.comment.startswith(';LAYER:'):
+            self.layer_start(g)
+        if g.command == 'G0' and g.Z is not None:
             return self.LayerCode
         else:
             self.output.append(g)
@@ -233,72 +483,168 @@ class GCodeTranslator(GCodeProcessor):
             self.output.append(g)
             return
         
-        if g.command == 'G0' and 'Z' in g.args:
-            z_height = g.args['Z']
-            self.layer_z = float(z_height)
-            if self.first_z is None:
-                self.first_z = self.layer_z
+        layer_move = g.command == 'G0' and g.Z is not None
+        if layer_move:
+            self.set_layer(g.Z)
             
-        target_x = float(g.args['X']) if 'X' in g.args else self.last_x
-        target_y = float(g.args['Y']) if 'Y' in g.args else self.last_y
+        target_x = g.X
+        if target_x is None:
+            target_x = self.last_x
+        target_y = g.Y
+        if target_y is None:
+            target_y = self.last_y
 
-        if g.command == 'G0' and 'Z' in g.args:
-            g.args['Z'] = self.target_z(target_x, target_y, self.layer_z)
-            self.output.append(g)
-            self.last_x = target_x
-            self.last_y = target_y
-            return
+        self.emit_move(g, target_x, target_y, layer_move)
 
-        if target_y == self.last_y:
-            new_g = copy.deepcopy(g)
-            new_g.args['Z'] = self.target_z(target_x, target_y, self.layer_z)
-            self.output.append(new_g)
-            
-        else:
-            ir = {
-                'X': (self.last_x, target_x),
-                'Y': (self.last_y, target_y),
-            }
-            if 'E' in g.args:
-                ir['E'] = (self.last_e, float(g.args['E']))
-        
-            for point in interpolate(4, **ir):
-                point['Z'] = self.target_z(point['X'], point['Y'], self.layer_z)
-                new_g = copy.deepcopy(g)
-                new_g.args.update(point)
-                self.output.append(new_g)
-            
         self.last_x = target_x
         self.last_y = target_y
-        if 'E' in new_g.args:
-            self.last_e = float(new_g.args['E'])
+        if not layer_move and g.E is not None:
+            self.last_e = g.E
+
+    def layer_start(self, g):
+        """Called with each ;LAYER: line, before it is handled."""
+        pass
+
+    def emit_move(self, g, target_x, target_y, layer_move):
+        """Output the curved version of move g.
+
+        last_x, last_y and last_e still hold the previous position;
+        LayerCode updates them afterwards.
+
+        """
+        if layer_move or target_y == self.last_y:
+            new_g = g.clone()
+            new_g.Z = self.target_z(target_y)
+            self.output.append(new_g)
+            return
+
+        e = None
+        if g.E is not None:
+            e = (self.last_e, g.E)
+
+        n = self.segment_points(
+            self.last_x, target_x, self.last_y, target_y)
+        for x, y, e_val, z in self.compute_segment(
+                self.last_x, target_x, self.last_y, target_y, e, n):
+            new_g = g.clone()
+            new_g.X = x
+            new_g.Y = y
+            if e_val is not None:
+                new_g.E = e_val
+            new_g.Z = z
+            self.output.append(new_g)
 
     def EndStage(self, g):
         self.output.append(g)
 
 
+class GCodeLayerSplitter(GCodeTranslator):
+    """Find where each layer starts and the translator state there.
+
+    Runs the translator's own states, but skips emitting moves and
+    discards the output. For each ;LAYER: line, layers records the
+    line and the (first_z, last_x, last_y, last_e) a translator has on
+    reaching it, so layers can be translated independently.
+
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.layers = []
+
+    def handle_stream(self, gs):
+        out = self.output
+        for _ in self.iter_stream(gs):
+            out.clear()
+
+    def layer_start(self, g):
+        self.layers.append((g, (self.first_z, self.last_x,
+                                self.last_y, self.last_e)))
+
+    def emit_move(self, g, target_x, target_y, layer_move):
+        pass
+
+
+def _translate_chunk(model, seed, lines):
+    """Translate a run of lines, starting from the given layer state.
+
+    A seed of None starts at the beginning of the file. Returns None
+    if nothing was output.
+
+    """
+    proc = GCodeTranslator(model)
+    if seed is not None:
+        proc.first_z, proc.last_x, proc.last_y, proc.last_e = seed
+        proc.state = proc.LayerHeader
+    proc.handle_stream(GCode.parse(line) for line in lines)
+    if proc.output:
+        return '\n'.join(map(str, proc.output))
+
+
+def translate_parallel(model, lines, parsed, jobs):
+    """Translate the file layer by layer across jobs processes.
+
+    lines and parsed are the raw and parsed lines of the file. Each
+    worker parses its own layers and returns formatted text, which is
+    cheaper to send back than GCode objects.
+
+    """
+    splitter = GCodeLayerSplitter(model)
+    splitter.handle_stream(parsed)
+
+    seeds = [None]
+    chunks = [[]]
+    starts = iter(splitter.layers)
+    next_start = next(starts, (None, None))
+    for line, g in zip(lines, parsed):
+        if g is next_start[0]:
+            seeds.append(next_start[1])
+            chunks.append([])
+            next_start = next(starts, (None, None))
+        chunks[-1].append(line)
+
+    chunksize = max(1, len(chunks) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as ex:
+        for text in ex.map(_translate_chunk, itertools.repeat(model),
+                           seeds, chunks, chunksize=chunksize):
+            if text is not None:
+                yield text
+
+
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument('gcode')
     argparser.add_argument('--depress', type=float, default=0.1)
+    argparser.add_argument('--jobs', type=int, default=1,
+                           help='translate layers in parallel '
+                           '(0 for one per CPU)')
 
     args = argparser.parse_args()
+    if args.jobs < 0:
+        argparser.error('--jobs must not be negative')
 
-    with open(args.gcode) as fp:
-        lines = fp.readlines()
+    jobs = args.jobs or os.cpu_count() or 1
+
+    with open(args.gcode, buffering=1 << 20) as fp:
+        if jobs > 1:
+            lines = fp.readlines()
+            parsed = [GCode.parse(line) for line in lines]
+        else:
+            parsed = [GCode.parse(line) for line in fp]
 
     model = GCodeScanner(td=args.depress)
-    for line in lines:
-        model.handle_line(line)
+    model.handle_stream(parsed)
+    model.finalize()
 
     print(';', model.__dict__)
-        
-    proc = GCodeTranslator(model)
-    for line in lines:
-        proc.handle_line(line)
 
-    for line in proc.output:
-        print(line)
+    if jobs > 1:
+        for text in translate_parallel(model, lines, parsed, jobs):
+            sys.stdout.write(text)
+            sys.stdout.write('\n')
+        return
+
+    proc = GCodeTranslator(model)
+    sys.stdout.writelines(f'{g}\n' for g in proc.stream(parsed))
 
 if __name__ == '__main__':
     main()